@@ -1,11 +1,16 @@
+import asyncio
+import atexit
+import ctypes
 import os
 import time
 import psutil
-import json
 import re
 import subprocess
+import sys
 import httpx
+import orjson
 from datetime import datetime, timezone
+from typing import NamedTuple, Sequence, Union
 from pydantic import Field
 from pathlib import Path
 from pydantic import BaseModel
@@ -16,29 +21,37 @@ from rich.panel import Panel
 # Config models
 #---------------------
 
+DEFAULT_MODEL = "llama3.1:8b"
+
 class RunConfig(BaseModel):
-	model: str="llama3.1:8b"
+	model: str=DEFAULT_MODEL
 	temperature: float = 0.2
 	prompt: str
 
 
 class SystemMetrics(BaseModel):
 	wall_time_s: float
-	cpu_percent: float
-	mem_rss_mb: float
-	system_mem_used_mb: float
-	system_mem_available_mb: float
-
-	swap_used_mb:float
-	swap_total_mb: float
+	# Whole-process CPU over this run's call window. Runs in a sweep overlap,
+	# so these include CPU used by other in-flight requests and are not
+	# additive across runs.
+	process_cpu_user_s: float
+	process_cpu_system_s: float
+	process_cpu_percent: float
+	# Memory is stored as raw byte counts
+	mem_rss_bytes: int
+	system_mem_used_bytes: int
+	system_mem_available_bytes: int
+
+	swap_used_bytes: int
+	swap_total_bytes: int
 	memory_pressure: str # "low" | "medium" | "high"
-	vm_available_mb: float
-	vm_compressed_mb: float
+	vm_available_bytes: int
+	vm_compressed_bytes: int
 
 class RunResult(BaseModel):
 	config: RunConfig
 	response: str
-	created_at: str
+	created_at: datetime
 	metrics: SystemMetrics
 
 
@@ -46,7 +59,103 @@ class RunResult(BaseModel):
 #-------------------
 #Collect Metrics
 #-------------------
+class _VMStatistics64(ctypes.Structure):
+	# vm_statistics64_data_t from <mach/vm_statistics.h>
+	_fields_ = [
+		("free_count", ctypes.c_uint32),
+		("active_count", ctypes.c_uint32),
+		("inactive_count", ctypes.c_uint32),
+		("wire_count", ctypes.c_uint32),
+		("zero_fill_count", ctypes.c_uint64),
+		("reactivations", ctypes.c_uint64),
+		("pageins", ctypes.c_uint64),
+		("pageouts", ctypes.c_uint64),
+		("faults", ctypes.c_uint64),
+		("cow_faults", ctypes.c_uint64),
+		("lookups", ctypes.c_uint64),
+		("hits", ctypes.c_uint64),
+		("purges", ctypes.c_uint64),
+		("purgeable_count", ctypes.c_uint32),
+		("speculative_count", ctypes.c_uint32),
+		("decompressions", ctypes.c_uint64),
+		("compressions", ctypes.c_uint64),
+		("swapins", ctypes.c_uint64),
+		("swapouts", ctypes.c_uint64),
+		("compressor_page_count", ctypes.c_uint32),
+		("throttled_count", ctypes.c_uint32),
+		("external_page_count", ctypes.c_uint32),
+		("internal_page_count", ctypes.c_uint32),
+		("total_uncompressed_pages_in_compressor", ctypes.c_uint64),
+	]
+
+_HOST_VM_INFO64 = 4
+_HOST_VM_INFO64_COUNT = ctypes.sizeof(_VMStatistics64) // ctypes.sizeof(ctypes.c_int32)
+
+def _load_mach() -> tuple:
+	"""
+	Load libSystem and resolve the host port and page size once.
+	Returns (None, None, None) when not on macOS.
+	"""
+	try:
+		libc = ctypes.CDLL("/usr/lib/libSystem.dylib")
+	except OSError:
+		return None, None, None
+
+	libc.mach_host_self.restype = ctypes.c_uint32
+	libc.host_page_size.argtypes = [ctypes.c_uint32, ctypes.POINTER(ctypes.c_size_t)]
+	libc.host_statistics64.argtypes = [
+		ctypes.c_uint32,
+		ctypes.c_int,
+		ctypes.POINTER(_VMStatistics64),
+		ctypes.POINTER(ctypes.c_uint32),
+	]
+
+	host = libc.mach_host_self()
+	page_size = ctypes.c_size_t()
+	if libc.host_page_size(host, ctypes.byref(page_size)) != 0:
+		return None, None, None
+	return libc, host, page_size.value
+
+_LIBC, _HOST, _PAGE_SIZE = _load_mach()
+
 def _read_vm_stat() -> dict:
+	"""
+	Read macOS VM statistics and return:
+	- page_size_bytes
+	- pages_free
+	- pages_speculative
+	- pages_compressed
+
+	Uses host_statistics64 directly; falls back to the vm_stat binary
+	if libSystem could not be loaded.
+	"""
+	if _LIBC is None:
+		return _read_vm_stat_subprocess()
+
+	stats = _VMStatistics64()
+	count = ctypes.c_uint32(_HOST_VM_INFO64_COUNT)
+	if _LIBC.host_statistics64(_HOST, _HOST_VM_INFO64, ctypes.byref(stats), ctypes.byref(count)) != 0:
+		return _read_vm_stat_subprocess()
+
+	# vm_stat reports "Pages free" net of speculative pages; match it so
+	# collect_metrics doesn't count speculative pages twice
+	return {
+		"page_size": _PAGE_SIZE,
+		"pages_free": stats.free_count - stats.speculative_count,
+		"pages_spec": stats.speculative_count,
+		"pages_comp": stats.compressor_page_count,
+	}
+
+# First line looks like: "match Virtual Memory Statistics: (page size of 16384 bytes)"
+_PAGE_RE = re.compile(rb"page size of (\d+) bytes")
+_PAGES_RE = re.compile(rb"(Pages free|Pages speculative|Pages occupied by compressor):\s+(\d+)\.")
+_PAGES_KEYS = {
+	b"Pages free": "pages_free",
+	b"Pages speculative": "pages_spec",
+	b"Pages occupied by compressor": "pages_comp",
+}
+
+def _read_vm_stat_subprocess() -> dict:
 	"""
 	Parse macOS vm_stat output and return:
 	- page_size_bytes
@@ -54,26 +163,16 @@ def _read_vm_stat() -> dict:
 	- pages_speculative
 	- pages_compressed
 	"""
-	out = subprocess.check_output(["vm_stat"], text=True)
+	out = subprocess.check_output(["vm_stat"])
 
-	# First line looks like: "match Virtual Memory Statistics: (page size of 16384 bytes)"
-	m = re.search(r"page size of (\d+) bytes", out)
+	m = _PAGE_RE.search(out)
 	page_size = int(m.group(1)) if m else 4096
 
-	def get_pages(label: str) -> int:
-		mm = re.search(rf"{re.escape(label)}:\s+(\d+)\.", out)
-		return int(mm.group(1)) if mm else 0
-	
-	pages_free = get_pages("Pages free")
-	pages_spec = get_pages("Pages speculative")
-	pages_comp = get_pages("Pages occupied by compressor")
+	stats = {"page_size": page_size, "pages_free": 0, "pages_spec": 0, "pages_comp": 0}
+	for mm in _PAGES_RE.finditer(out):
+		stats[_PAGES_KEYS[mm.group(1)]] = int(mm.group(2))
 
-	return {
-		"page_size": page_size,
-		"pages_free": pages_free,
-		"pages_spec": pages_spec,
-		"pages_comp": pages_comp
-	}
+	return stats
 
 def _pressure_level(system_available_mb: float, swap_used_mb: float) -> str:
 	if swap_used_mb > 256 or system_available_mb < 1024:
@@ -82,73 +181,181 @@ def _pressure_level(system_available_mb: float, swap_used_mb: float) -> str:
 		return "medium"
 	return "low"
 	
-def collect_metrics(start_time:float) -> SystemMetrics:
-	proc = psutil.Process(os.getpid())
-
-	# Percent since last call; prime it once so next call is meaningful
-	proc.cpu_percent(interval=None)
-	cpu_percent = proc.cpu_percent(interval=0.1)
+_PROC = psutil.Process(os.getpid())
+_MB = 1.0 / (1 << 20)
+
+class _Snapshot(NamedTuple):
+	end_time: float
+	cpu_times: tuple
+	rss: int
+	vm: tuple
+	sm: tuple
+	vmstat: dict
+
+def _snapshot() -> _Snapshot:
+	"""Read every raw counter at once, when a response finishes."""
+	end_time = time.perf_counter()
+	# oneshot() shares one set of proc_pidinfo calls across both reads
+	with _PROC.oneshot():
+		cpu_times = _PROC.cpu_times()
+		rss = _PROC.memory_info().rss
+	return _Snapshot(
+		end_time=end_time,
+		cpu_times=cpu_times,
+		rss=rss,
+		vm=psutil.virtual_memory(),
+		sm=psutil.swap_memory(),
+		vmstat=_read_vm_stat(),
+	)
 
-	rss_mb = proc.memory_info().rss / (1024*1024)
+def collect_metrics(start_time: float, cpu_start, snap: _Snapshot) -> SystemMetrics:
+	"""
+	Build SystemMetrics for a call that started at start_time from the
+	counters in snap, taken when the response finished.
+	"""
+	wall_time_s = snap.end_time - start_time
+	cpu_end = snap.cpu_times
+	rss = snap.rss
 
-	vm = psutil.virtual_memory()
-	used_mb = vm.used / (1024 * 1024)
-	avail_mb = vm.available / (1024 * 1024)
+	# CPU time spent by the whole process during the call window, from
+	# counter deltas; concurrent requests share these counters
+	cpu_user = cpu_end.user - cpu_start.user
+	cpu_sys = cpu_end.system - cpu_start.system
+	cpu_percent = 100.0 * (cpu_user + cpu_sys) / wall_time_s if wall_time_s > 0 else 0.0
 
-	sm = psutil.swap_memory()
-	swap_used_mb = sm.used / (1024 * 1024)
-	swap_total_mb = sm.total / (1024 * 1024)
+	vm = snap.vm
+	sm = snap.sm
 
 	# macOS-specific memory pressure-ish signals
-	vmstat = _read_vm_stat()
+	vmstat = snap.vmstat
 	page_size = vmstat["page_size"]
 	vm_available_bytes = (vmstat["pages_free"]+ vmstat["pages_spec"]) * page_size
 	vm_compressed_bytes = vmstat["pages_comp"] * page_size
 
-	vm_available_mb = vm_available_bytes / (1024 * 1024)
-	vm_compressed_mb = vm_compressed_bytes / (1024 * 1024)
-
-	pressure = _pressure_level(avail_mb, swap_used_mb)
+	pressure = _pressure_level(vm.available * _MB, sm.used * _MB)
 
 	return SystemMetrics(
-		wall_time_s=round(time.time() - start_time, 4),
-		cpu_percent=cpu_percent,
-		mem_rss_mb=round(rss_mb, 2),
-		system_mem_used_mb=round(used_mb, 2),
-		system_mem_available_mb=round(avail_mb, 2),
-		swap_used_mb=round(swap_used_mb, 2),
-		swap_total_mb=round(swap_total_mb, 2),
+		wall_time_s=wall_time_s,
+		process_cpu_user_s=cpu_user,
+		process_cpu_system_s=cpu_sys,
+		process_cpu_percent=cpu_percent,
+		mem_rss_bytes=rss,
+		system_mem_used_bytes=vm.used,
+		system_mem_available_bytes=vm.available,
+		swap_used_bytes=sm.used,
+		swap_total_bytes=sm.total,
 		memory_pressure=pressure,
-		vm_available_mb=round(vm_available_mb,2),
-		vm_compressed_mb=round(vm_compressed_mb, 2),
+		vm_available_bytes=vm_available_bytes,
+		vm_compressed_bytes=vm_compressed_bytes,
 	)
 
 #--------------------
 # Ollama call
 #-------------------
+# Requests are fired concurrently; start the server with OLLAMA_NUM_PARALLEL=4
+# (or >= len(temps)) so they are actually served in parallel. The same variable
+# caps how many requests the sweep keeps in flight at once.
 OLLAMA_URL = "http://localhost:11434/api/generate"
 
-def run_prompt(config: RunConfig) -> RunResult:
-	start = time.time()
-
-	payload = {
+def _num_parallel() -> int:
+	"""Read OLLAMA_NUM_PARALLEL (default 4); it must be an integer >= 1."""
+	raw = os.getenv("OLLAMA_NUM_PARALLEL", "4")
+	try:
+		value = int(raw)
+	except ValueError:
+		value = 0
+	if value < 1:
+		raise ValueError(f"OLLAMA_NUM_PARALLEL must be an integer >= 1, got {raw!r}")
+	return value
+
+# One keep-alive pool shared by every sync call instead of a client per prompt.
+_CLIENT = httpx.Client(
+	timeout=60.0,
+	limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+)
+atexit.register(_CLIENT.close)
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _request_body(config: RunConfig) -> bytes:
+	# Encoded with orjson and sent as raw content rather than httpx's json=
+	return orjson.dumps({
 		"model": config.model,
 		"prompt": config.prompt,
 		"temperature": config.temperature,
-		"stream": False,
-	}
-	
-	with httpx.Client(timeout=60.0) as client:
-		r = client.post(OLLAMA_URL, json = payload)
+		"stream": True,
+	})
+
+class OllamaError(RuntimeError):
+	"""Ollama reported an error or ended the stream early."""
+
+def _feed_line(chunks: list[str], line: str) -> bool:
+	"""
+	Append the text of one NDJSON line to chunks.
+	Returns True once the line carrying "done": true is seen.
+	"""
+	if not line:
+		return False
+	obj = orjson.loads(line)
+	# Mid-stream failures arrive as {"error": "..."} with HTTP 200
+	if "error" in obj:
+		raise OllamaError(obj["error"])
+	chunks.append(obj.get("response", ""))
+	return bool(obj.get("done"))
+
+def _join_response(chunks: list[str], done: bool) -> str:
+	if not done:
+		raise OllamaError("stream ended before the done marker")
+	return "".join(chunks).strip()
+
+def run_prompt(config: RunConfig) -> RunResult:
+	start = time.perf_counter()
+
+	body = _request_body(config)
+
+	# Ollama streams NDJSON: one object per token batch, the last has "done": true
+	chunks = []
+	cpu_start = _PROC.cpu_times()
+	with _CLIENT.stream("POST", OLLAMA_URL, content = body, headers = _JSON_HEADERS) as r:
 		r.raise_for_status()
-		data = r.json()
-	
-	metrics = collect_metrics(start)
-	
+		done = False
+		for line in r.iter_lines():
+			if _feed_line(chunks, line):
+				done = True
+				break
+
+	metrics = collect_metrics(start, cpu_start, _snapshot())
+
+	return RunResult(
+		config = config,
+		response = _join_response(chunks, done),
+		created_at = datetime.now(timezone.utc),
+		metrics = metrics,
+	)
+
+async def arun_prompt(client: httpx.AsyncClient, config: RunConfig) -> RunResult:
+	start = time.perf_counter()
+
+	body = _request_body(config)
+
+	chunks = []
+	cpu_start = _PROC.cpu_times()
+	async with client.stream("POST", OLLAMA_URL, content = body, headers = _JSON_HEADERS) as r:
+		r.raise_for_status()
+		done = False
+		async for line in r.aiter_lines():
+			if _feed_line(chunks, line):
+				done = True
+				break
+
+	# psutil reads (and the vm_stat fallback) block, so keep them off the loop
+	snap = await asyncio.to_thread(_snapshot)
+	metrics = collect_metrics(start, cpu_start, snap)
+
 	return RunResult(
 		config = config,
-		response = data["response"].strip(),
-		created_at = datetime.now(timezone.utc).isoformat(),
+		response = _join_response(chunks, done),
+		created_at = datetime.now(timezone.utc),
 		metrics = metrics,
 	)
 
@@ -156,16 +363,39 @@ def run_prompt(config: RunConfig) -> RunResult:
 # Save run
 #-----------------
 
-def save_run(result: RunResult) -> Path:
-	runs_dir = Path("runs")
-	runs_dir.mkdir(exist_ok=True)
+RUNS_DIR = Path("runs")
+RUNS_DIR.mkdir(exist_ok=True)
 
-	timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-	temp_str = str(result.config.temperature).replace(".", "p")
-	file_path = runs_dir / f"run_{timestamp}_t{temp_str}.json"
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w.-]")
 
-	with open(file_path, "w") as f:
-		json.dump(result.model_dump(), f, indent=2)
+def save_run(result: RunResult) -> Path:
+	model_str = _UNSAFE_FILENAME_RE.sub("_", result.config.model)
+	temp_str = repr(result.config.temperature).replace(".", "p")
+	stem = f"run_{result.created_at:%Y%m%d_%H%M%S}_{model_str}_t{temp_str}"
+
+	# Straight to JSON bytes in pydantic-core, no intermediate dict
+	payload = RunResult.__pydantic_serializer__.to_json(result, indent=2)
+
+	# Raw writes, bypassing the buffered IO stack; loop so a short
+	# write can never leave a truncated file behind
+	view = memoryview(payload)
+
+	# Concurrent runs of the same config can finish in the same second.
+	# O_EXCL never overwrites an existing run; a numeric suffix keeps both.
+	file_path = RUNS_DIR / f"{stem}.json"
+	n = 1
+	while True:
+		try:
+			fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+			break
+		except FileExistsError:
+			file_path = RUNS_DIR / f"{stem}_{n}.json"
+			n += 1
+	try:
+		while view:
+			view = view[os.write(fd, view):]
+	finally:
+		os.close(fd)
 
 	return file_path
 
@@ -173,35 +403,84 @@ def save_run(result: RunResult) -> Path:
 # Main
 #---------------
 
-if __name__ == "__main__":
-	console = Console()	
+async def _sweep_async(configs: list[RunConfig], parallel: int) -> list[Union[RunResult, BaseException]]:
+	sem = asyncio.Semaphore(parallel)
 
-	prompt = "Explain what temperature does in large language models in simple terms. Give a short example."
-	temps = [0.0, 0.3, 0.7, 1.1]
+	async def bounded(client: httpx.AsyncClient, config: RunConfig) -> RunResult:
+		async with sem:
+			return await arun_prompt(client, config)
 
-	console.print(f"Model: [bold]{RunConfig.model_default if hasattr(RunConfig, 'model_default') else 'llama3.1:8b'}[/bold]", style="dim")
-	console.print("Running temperature comparison...\n", style="bold cyan")
-
-	for t in temps:
-		config = RunConfig(
-			model = "llama3.1:8b",
-			temperature = t,
-			prompt = prompt,
+	async with httpx.AsyncClient(timeout=60.0) as client:
+		# One failed config must not discard the runs that succeeded
+		return await asyncio.gather(
+			*(bounded(client, c) for c in configs),
+			return_exceptions=True,
 		)
-		console.print(f"[bold]Temperature:[/bold] {t}", style="yellow")
-		result = run_prompt(config)
-		path = save_run(result)
 
+def sweep(
+	temps: list[float],
+	prompt: str,
+	models: Sequence[str] = (DEFAULT_MODEL,),
+) -> tuple[list[RunResult], list[tuple[RunConfig, BaseException]]]:
+	"""
+	Run the full models x temps matrix at once.
+	Returns (runs, failures): the results that succeeded and the
+	(config, exception) pairs that did not.
+	"""
+	parallel = _num_parallel()
+	configs = [
+		RunConfig(model=m, temperature=t, prompt=prompt)
+		for m in models
+		for t in temps
+	]
+	runs, failures = [], []
+	for config, outcome in zip(configs, asyncio.run(_sweep_async(configs, parallel))):
+		if isinstance(outcome, BaseException):
+			failures.append((config, outcome))
+		else:
+			runs.append(outcome)
+	return runs, failures
+
+def main(
+	temps: list[float],
+	prompt: str,
+	models: Sequence[str] = (DEFAULT_MODEL,),
+) -> list[tuple[RunConfig, BaseException]]:
+	console = Console()
+	# Plain informational lines skip markup parsing and highlighting
+	info = Console(highlight=False, markup=False)
+
+	console.print(f"Models: [bold]{', '.join(models)}[/bold]", style="dim")
+	info.out("Running temperature comparison...\n", style="bold cyan")
+
+	runs, failures = sweep(temps, prompt, models)
+
+	for result in runs:
+		m = result.config.model
+		t = result.config.temperature
+
+		console.print(f"[bold]Model:[/bold] {m}  [bold]Temperature:[/bold] {t}", style="yellow")
 		console.print(
 			Panel(
-				result.response.strip(),
-				title=f"Respone (t={t})",
+				result.response,
+				title=f"Response ({m}, t={t})",
 				border_style="green",
 			)
 		)
-		console.print(f"Saved run to {path}\n", style="dim")
-	
 
-	
+		path = save_run(result)
+		info.out(f"Saved run to {path}\n", style="dim")
+
+	for config, exc in failures:
+		info.out(
+			f"Failed ({config.model}, t={config.temperature}): {type(exc).__name__}: {exc}",
+			style="bold red",
+		)
+
+	return failures
 
 
+if __name__ == "__main__":
+	prompt = "Explain what temperature does in large language models in simple terms. Give a short example."
+	if main([0.0, 0.3, 0.7, 1.1], prompt):
+		sys.exit(1)